@@ -9,6 +9,7 @@ import sys
 import warnings
 
 import analyze
+import util
 
 # from ISO 12232:1998 via https://en.wikipedia.org/wiki/Film_speed#Measurements_and_calculations
 # H = qLt/(N^2)
@@ -84,6 +85,8 @@ if __name__ == '__main__':
 
 	analyze.set_arguments(parser)
 
+	util.remove_arguments(parser, 'processes')
+
 	args = parser.parse_args(sys.argv[1:])
 	args_dict = vars(args)
 	main(**args_dict)
@@ -1,9 +1,11 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import csv
 import numpy as np
 import os
 import pandas as pd
 import matplotlib.pyplot as plt
+import multiprocessing
 import re
 import seaborn as sns
 import sys
@@ -57,13 +59,12 @@ class Image:
 		self.subtr_img = None
 		self.mask = None
 		self.normalized_value = None
+		self.prefetched = {}
 		self.value = None
 
 	def get_bf_img(self):
 		if self.bf_img is None:
-			with warnings.catch_warnings():
-				warnings.simplefilter("ignore", UserWarning)
-				self.bf_img = imageops.read(self.bf_filename, np.uint16)
+			self.bf_img = self._read(self.bf_filename)
 		return self.bf_img
 
 	def get_bf_metadata(self):
@@ -73,9 +74,7 @@ class Image:
 
 	def get_fl_img(self):
 		if self.fl_img is None:
-			with warnings.catch_warnings():
-				warnings.simplefilter("ignore", UserWarning)
-				self.fl_img = imageops.read(self.fl_filename, np.uint16, self.channel)
+			self.fl_img = self._read(self.fl_filename, self.channel)
 		return self.fl_img
 
 	def get_fl_metadata(self):
@@ -85,7 +84,7 @@ class Image:
 
 	def get_mask(self):
 		if self.mask is None:
-			self.mask = imageops.get_fish_mask(
+			self.mask = imageops.get_fish_mask_cached(
 				self.get_bf_img(), self.get_fl_img(), particles=self.particles,
 				silent=self.debug < 1, verbose=self.debug >= 2,
 				v_file_prefix='{}_XY{:02d}'.format(self.plate, self.xy),
@@ -103,14 +102,8 @@ class Image:
 		return self.value
 
 	def get_subtr_img(self):
-		if self.subtr_img is None:
-			if os.path.isfile(self.subtr_filename):
-				with warnings.catch_warnings():
-					warnings.simplefilter("ignore", UserWarning)
-					self.subtr_img = imageops.read(
-						self.subtr_filename, np.uint16, self.channel_subtr)
-			else:
-				self.subtr_img = []
+		if self.subtr_img is None and os.path.isfile(self.subtr_filename):
+			self.subtr_img = self._read(self.subtr_filename, self.channel_subtr)
 		return self.subtr_img
 
 	def normalize(self, control_values, cap):
@@ -126,15 +119,32 @@ class Image:
 			self.normalized_value = np.nan
 		return self
 
+	def prefetch(self, executor):
+		if self.value is not None:
+			return
+		reads = [(self.bf_filename, -1), (self.fl_filename, self.channel)]
+		if os.path.isfile(self.subtr_filename):
+			reads.append((self.subtr_filename, self.channel_subtr))
+		for filename, channel in reads:
+			self.prefetched[(filename, channel)] = executor.submit(
+				imageops.read, filename, np.uint16, channel)
+
+	def _read(self, filename, channel=-1):
+		future = self.prefetched.pop((filename, channel), None)
+		if future is not None:
+			return future.result()
+		with warnings.catch_warnings():
+			warnings.simplefilter("ignore", UserWarning)
+			return imageops.read(filename, np.uint16, channel)
+
 class UserError(ValueError):
 	pass
 
 def chart(results, chartfile, scale='linear'):
 	with sns.axes_style(style='whitegrid'):
-		data = pd.DataFrame({
-			'brightness': [value for values in results.values() for value in values],
-			'group': [key for key, values in results.items() for _ in values],
-		})
+		data = pd.DataFrame(
+			[(key, value) for key, values in results.items() for value in values],
+			columns=['group', 'brightness'])
 
 		fig = plt.figure(figsize=(12, 8), dpi=100)
 		ax = sns.swarmplot(x='group', y='brightness', data=data)
@@ -173,15 +183,16 @@ def get_schematic(platefile, target_count, plate_ignore=[], flat=True):
 	return schematic if not flat else [well for row in schematic for well in row]
 
 def main(imagefiles, cap=-1, chartfile=None, debug=0, group_regex='.*', platefile=None,
-		plate_control=['B'], plate_ignore=[], silent=False):
+		plate_control=['B'], plate_ignore=[], processes=None, silent=False):
 	results = {}
 
 	schematic = get_schematic(platefile, len(imagefiles), plate_ignore)
 	groups = list(dict.fromkeys(schematic))# deduplicated copy of `schematic`
-	images = quantify(imagefiles, plate_control, cap=cap, debug=debug, group_regex=group_regex,
-		schematic=schematic)
-
+	plate_control = frozenset(plate_control)
 	pattern = re.compile(group_regex)
+	images = quantify(imagefiles, plate_control, cap=cap, debug=debug, group_regex=pattern,
+		processes=processes, schematic=schematic)
+
 	for group in groups:
 		if group in plate_control or pattern.search(group):
 			relevant_values = [img.normalized_value for img in images if img.group == group]
@@ -196,30 +207,52 @@ def main(imagefiles, cap=-1, chartfile=None, debug=0, group_regex='.*', platefil
 
 	return results
 
-def quantify(imagefiles, plate_control=['B'], cap=-1, debug=0, group_regex='.*', schematic=None):
-	pattern = re.compile(group_regex)
+def quantify(imagefiles, plate_control=['B'], cap=-1, debug=0, group_regex='.*', processes=None,
+		schematic=None):
+	plate_control = frozenset(plate_control)
+	pattern = re.compile(group_regex)# no-op if already compiled
 	images = [Image(filename, group, debug) for filename, group in zip(imagefiles, schematic)
 		if group in plate_control or pattern.search(group)]
+	if not any(image.group in plate_control for image in images): # fail before scoring anything
+		raise UserError(
+			'No control wells found. Please supply a --plate-control, or modify the given value.')
+	_calculate_raw_values(images, processes)
+	imageops.reduce_mask_cache()
 	control_values = _calculate_control_values(images, plate_control)
 	return [image.normalize(control_values, cap) for image in images]
 
 def _calculate_control_values(images, plate_control):
 	ctrl_imgs = [img for img in images if img.group in plate_control]
-	ctrl_vals = {}
-
-	for plate in np.unique([img.plate for img in ctrl_imgs]):
-		ctrl_results = np.array([img.get_raw_value() for img in ctrl_imgs if img.plate == plate])
-		ctrl_vals[plate] = float(np.nanmedian(ctrl_results))
-
-	if not ctrl_vals:
-		raise UserError(
-			'No control wells found. Please supply a --plate-control, or modify the given value.')
-
-	return ctrl_vals
+	ctrl_results = pd.Series([img.get_raw_value() for img in ctrl_imgs], dtype=float)
+	ctrl_plates = [img.plate for img in ctrl_imgs]
+	return ctrl_results.groupby(ctrl_plates, sort=False).median().to_dict()
+
+def _calculate_raw_values(images, processes=None, prefetch_count=2, prefetch_threads=4):
+	processes = min(processes or os.cpu_count() or 1, len(images))
+	if processes <= 1:# read the next images in the background while the current one is processed
+		with warnings.catch_warnings(), ThreadPoolExecutor(prefetch_threads) as executor:
+			# catch_warnings isn't thread-safe, so silence the decoders by module instead of per read
+			warnings.filterwarnings("ignore", category=UserWarning, module='imageio|tifffile')
+			for image in images[:prefetch_count]:
+				image.prefetch(executor)
+			for i, image in enumerate(images):
+				if i + prefetch_count < len(images):
+					images[i + prefetch_count].prefetch(executor)
+				image.get_raw_value()
+		return
+
+	chunksize = max(1, len(images) // (4 * processes))
+	with multiprocessing.Pool(processes) as pool:
+		for i, value in pool.imap_unordered(_compute_raw_value, enumerate(images), chunksize):
+			images[i].value = value
 
 def _clean(s):
 	return ''.join(c for c in s if c.isprintable()).strip()
 
+def _compute_raw_value(indexed_image):# module-level so it can be pickled for worker processes
+	i, image = indexed_image
+	return i, image.get_raw_value()
+
 #
 # main
 #
@@ -267,6 +300,10 @@ def set_arguments(parser):
 		help=('Indicates intermediate processing images should be output for troubleshooting '
 			'purposes. Including this argument once will yield one intermediate image per input '
 			'file, twice will yield several intermediate images per input file.'))
+	parser.add_argument('-j', '--processes',
+		type=int,
+		help=('Number of worker processes to analyze images with. Defaults to the number of CPUs. '
+			'Pass 1 to analyze all images in this process, e.g. for debugging.'))
 	parser.add_argument('-s', '--silent',
 		action='store_true',
 		help=('If present, printed output will be suppressed. More convenient for programmatic '
@@ -1,14 +1,29 @@
 import argparse
 import cv2 as cv
 from skimage import feature
+import functools
+import hashlib
 import imageio
 import math
+import multiprocessing
 import numpy as np
 import os
 import sys
 from time import time
 import warnings
 
+try:
+	from numba import njit
+	_NUMBA_AVAILABLE = True
+except ImportError:
+	_NUMBA_AVAILABLE = False
+
+try:
+	from joblib import Memory
+	_JOBLIB_AVAILABLE = True
+except ImportError:
+	_JOBLIB_AVAILABLE = False
+
 import util
 
 base_log_dir = util.get_config('log_dir')
@@ -32,12 +47,15 @@ except OSError as ose:
 		'problem.'
 	)) from ose
 
+_BIT_DEPTH_TYPES = (np.uint8, np.uint16, np.int32)
+
 def apply_mask(img, mask):# mask should have black background, white foreground
-	img_type = _get_bit_depth(img)
-	return np.minimum(img, np.where(mask == 255, img_type[1], 0).astype(img_type[0]))
+	return img * (mask == 255)
 
 def binarize(img, threshold):
-	if threshold >= 0:
+	if threshold >= 0 and img.dtype.type in _BIT_DEPTH_TYPES:
+		return cv.compare(img, float(threshold), cv.CMP_LT) # cv rejects NumPy scalars
+	elif threshold >= 0:
 		return np.where(img < threshold, 255, 0).astype(np.uint8)
 	else:
 		return img
@@ -78,11 +96,12 @@ def get_aspect_mask(img, target_ratio=5, error_bound=0.5, verbose=False):
 def get_contours_by_area(img, threshold=-1, lower=0, upper=2**32):
 	binarized_img = binarize(img, threshold)
 	contours, _ = cv.findContours(binarized_img, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)
-	areas = np.array([cv.contourArea(contour) for contour in contours])
-	return [contour for contour, area in zip(contours, areas) if area > lower and area < upper]
+	areas = np.fromiter((cv.contourArea(contour) for contour in contours), dtype=np.float64,
+		count=len(contours))
+	return [contours[i] for i in np.flatnonzero((areas > lower) & (areas < upper))]
 
 def get_fish_mask(bf_img, fl_img, particles=True, silent=True, verbose=False, v_file_prefix='',
-		mask_filename=None, subtr_img=[]):
+		mask_filename=None, subtr_img=None):
 	show(bf_img, verbose or not silent, v_file_prefix=v_file_prefix)
 	show(fl_img, verbose or not silent, v_file_prefix=v_file_prefix)
 
@@ -132,6 +151,16 @@ def get_fish_mask(bf_img, fl_img, particles=True, silent=True, verbose=False, v_
 	show(apply_mask(fl_img, mask), not verbose and not silent, v_file_prefix=v_file_prefix)
 	return mask
 
+def get_fish_mask_cached(bf_img, fl_img, particles=True, silent=True, verbose=False,
+		v_file_prefix='', mask_filename=None, subtr_img=None):
+	memory = _get_memory()
+	if memory is None or verbose or not silent: # intermediate images only get shown when computed
+		return get_fish_mask(bf_img, fl_img, particles=particles, silent=silent, verbose=verbose,
+			v_file_prefix=v_file_prefix, mask_filename=mask_filename, subtr_img=subtr_img)
+	mask_mtime = _get_mtime(mask_filename) if mask_filename else None
+	return memory.cache(_get_fish_mask_cached)(bf_img, fl_img, particles, mask_filename,
+		mask_mtime, subtr_img, _get_pipeline_version())
+
 def get_size_mask(img, erosions=0, threshold=2**7, lower=0, upper=2**32, verbose=False,
 		v_file_prefix=''):
 	contours = get_contours_by_area(img, threshold, lower, upper)
@@ -143,6 +172,8 @@ def get_size_mask(img, erosions=0, threshold=2**7, lower=0, upper=2**32, verbose
 	return _get_mask(img, steps, verbose, v_file_prefix=v_file_prefix)
 
 def invert(img):
+	if img.dtype.type in (np.uint8, np.uint16): # max - img is just a bit flip for unsigned types
+		return cv.bitwise_not(img)
 	return np.subtract(_get_bit_depth(img)[1], img)
 
 def read(filename, target_bit_depth, channel=-1):
@@ -150,35 +181,44 @@ def read(filename, target_bit_depth, channel=-1):
 	if channel >= 0:
 		img = img[:,:,channel]
 
-	bit_depth = _get_bit_depth(img)
+	bit_depth = _get_bit_depth(img, from_data=True) # dim uint16 files are stretched like 8-bit ones
 	if bit_depth[0] != target_bit_depth:
-		img = (img * (np.iinfo(target_bit_depth).max / bit_depth[1])).astype(target_bit_depth)
+		scale = np.iinfo(target_bit_depth).max / bit_depth[1]
+		img = np.multiply(img, scale, out=np.empty(img.shape, target_bit_depth), casting='unsafe')
 
 	return img
 
+def reduce_mask_cache():
+	memory = _get_memory()
+	if memory is not None:
+		memory.reduce_size(bytes_limit=util.get_config('mask_cache_size'))
+
 def rescale_brightness(img):
 	img_type = _get_bit_depth(img)
-	return ((img - img.min()) * (img_type[1] / img.max())).astype(img_type[0])
+	return np.multiply(img - img.min(), img_type[1] / img.max(), out=np.empty(img.shape, img_type[0]),
+		casting='unsafe')
 
 def resize(img, factor):
 	return cv.resize(img, None, fx=factor, fy=factor)
 
 def score(img, count=10, radius=8, threshold_pct=0.05):
 	coordinates = _get_local_maxima(img, count=count, spacing=radius)
+	if _NUMBA_AVAILABLE:
+		return _score_numba(img, coordinates, radius, threshold_pct)
+
 	height, width = img.shape
+	disk = _get_disk(radius)
 	total = 0
 
 	for coord_y, coord_x in coordinates:
-		x_min, x_max = max(coord_x - radius, 0), min(coord_x + radius, width) # bounding box
-		y_min, y_max = max(coord_y - radius, 0), min(coord_y + radius, height)#
-		points = []
-		for x in range(x_min, x_max + 1):
-			for y in range(y_min, y_max + 1):
-				if (x - coord_x)**2 + (y - coord_y)**2 > radius**2: # Pythagorean theorem
-					continue
-				points.append(img[y][x])
-		relevant_points = sorted(points, reverse=True)[:int(len(points)*threshold_pct)]
-		total += np.sum(relevant_points, dtype=np.int64)
+		x_min, x_max = max(coord_x - radius, 0), min(coord_x + radius, width - 1) # bounding box
+		y_min, y_max = max(coord_y - radius, 0), min(coord_y + radius, height - 1)#
+		disk_slice = disk[y_min - coord_y + radius:y_max - coord_y + radius + 1,
+			x_min - coord_x + radius:x_max - coord_x + radius + 1]
+		points = img[y_min:y_max + 1, x_min:x_max + 1][disk_slice]
+		k = int(points.size * threshold_pct)
+		if k > 0:
+			total += np.partition(points, -k)[-k:].sum(dtype=np.int64)
 	return total
 
 def show(img, verbose=True, v_file_prefix=''):
@@ -189,12 +229,21 @@ def show(img, verbose=True, v_file_prefix=''):
 
 # NOTE: at the moment, it's assumed minuend_image and subtrahend_image have the same bit depth
 def subtract(minuend_image, subtrahend_image, scale=True, threshold=0.005):
+	ratio = 1.0
 	if scale:
 		threshold_px = _get_bit_depth(minuend_image)[1] * threshold
 		intersection_mask = (minuend_image > threshold_px) & (subtrahend_image > threshold_px)
 		minuend_masked_median = np.median(minuend_image[intersection_mask])
 		subtrahend_masked_median = np.median(subtrahend_image[intersection_mask])
-		scaled_image = subtrahend_image * (minuend_masked_median / subtrahend_masked_median)
+		ratio = minuend_masked_median / subtrahend_masked_median
+		if np.isnan(ratio): # images don't overlap, so there's nothing to subtract
+			ratio = 0.0
+
+	if _NUMBA_AVAILABLE:
+		return _subtract_numba(minuend_image, subtrahend_image, ratio, np.empty_like(minuend_image))
+
+	if scale: # saturate rather than wrap around where the scaled values exceed the bit depth
+		scaled_image = np.minimum(subtrahend_image * ratio, np.iinfo(subtrahend_image.dtype).max)
 		subtrahend_image = scaled_image.astype(subtrahend_image.dtype)
 	# subtract without underflow
 	return np.where(minuend_image < subtrahend_image, 0, minuend_image - subtrahend_image)
@@ -204,16 +253,50 @@ def _aspect_is_between(contour, upper, lower):
 	aspect_ratio = major / minor
 	return (aspect_ratio < upper) and (aspect_ratio > lower)
 
-def _get_bit_depth(img):
-	types = [(itype, np.iinfo(itype).max) for itype in [np.uint8, np.uint16, np.int32]]
+def _get_bit_depth(img, from_data=False):
+	if not from_data and img.dtype.type in _BIT_DEPTH_TYPES: # the dtype says it all, skip the scan
+		return (img.dtype.type, np.iinfo(img.dtype).max)
+	types = [(itype, np.iinfo(itype).max) for itype in _BIT_DEPTH_TYPES]
 	return types[np.digitize(img.max(), [itype[1] for itype in types], right=True)]
 
+@functools.lru_cache(maxsize=None)
+def _get_disk(radius):
+	yy, xx = np.ogrid[-radius:radius + 1, -radius:radius + 1]
+	disk = (xx**2 + yy**2) <= radius**2 # Pythagorean theorem
+	disk.flags.writeable = False # shared between calls
+	return disk
+
+def _get_fish_mask_cached(bf_img, fl_img, particles, mask_filename, mask_mtime, subtr_img,
+		pipeline_version):
+	return get_fish_mask(bf_img, fl_img, particles=particles, mask_filename=mask_filename,
+		subtr_img=subtr_img) # mask_mtime and pipeline_version are only part of the cache key
+
+@functools.lru_cache(maxsize=None)
 def _get_kernel(size):
 	return cv.getStructuringElement(cv.MORPH_ELLIPSE, (size*2 + 1, size*2 + 1), (size, size))
 
 def _get_local_maxima(img, count=10, spacing=5, threshold_rel=0.1):
-	return feature.peak_local_max(img, min_distance=spacing, num_peaks=count,
-		threshold_rel=threshold_rel)
+	if img.dtype.type not in (np.uint8, np.uint16, np.float32) or spacing < 1:
+		return feature.peak_local_max(img, min_distance=spacing, num_peaks=count,
+			threshold_rel=threshold_rel)
+
+	# same peaks as feature.peak_local_max, but with OpenCV's dilation as the maximum filter
+	peak_mask = img == cv.dilate(img, np.ones((spacing*2 + 1, spacing*2 + 1), dtype=np.uint8))
+	if peak_mask.all(): # no peaks in a flat image
+		return np.empty((0, 2), dtype=np.intp)
+	peak_mask &= img > max(img.min(), img.max() * threshold_rel)
+	peak_mask[:spacing], peak_mask[-spacing:] = False, False # exclude border
+	peak_mask[:, :spacing], peak_mask[:, -spacing:] = False, False #
+
+	candidates = np.argwhere(peak_mask)
+	candidates = candidates[np.argsort(-img[peak_mask].astype(np.float64), kind='stable')]
+	peaks = []
+	for candidate in candidates: # brightest first, skipping plateau neighbors of earlier peaks
+		if all(np.abs(candidate - peak).max() >= spacing for peak in peaks):
+			peaks.append(candidate)
+			if len(peaks) >= count:
+				break
+	return np.array(peaks, dtype=np.intp).reshape(-1, 2)
 
 def _get_mask(img, steps, verbose=False, v_file_prefix=''):
 	img_i = img
@@ -223,11 +306,92 @@ def _get_mask(img, steps, verbose=False, v_file_prefix=''):
 	show(apply_mask(img, img_i), verbose, v_file_prefix=v_file_prefix)
 	return img_i
 
+@functools.lru_cache(maxsize=None)
+def _get_memory():
+	if not _JOBLIB_AVAILABLE or util.get_config('mask_cache').lower() != 'true':
+		return None
+	return Memory(f'{LOG_DIR}/cache', compress=True, verbose=0) # masks are mostly zeros
+
+def _get_mtime(filename):
+	return os.path.getmtime(filename) if os.path.isfile(filename) else None
+
+@functools.lru_cache(maxsize=None)
+def _get_pipeline_version(): # changes whenever this module's code or OpenCV's version does
+	with open(__file__, 'rb') as f:
+		return hashlib.sha1(f.read() + cv.__version__.encode('utf-8')).hexdigest()
+
+if _NUMBA_AVAILABLE:
+	@njit(cache=True) # not parallel: a threaded parent cannot safely fork the analyze process pool
+	def _score_numba(img, coordinates, radius, threshold_pct):
+		height, width = img.shape
+		totals = np.zeros(coordinates.shape[0], np.int64) # one partial sum per peak
+
+		for i in range(coordinates.shape[0]):
+			buf = np.empty((2*radius + 1)**2, img.dtype)
+			coord_y, coord_x = coordinates[i, 0], coordinates[i, 1]
+			x_min, x_max = max(coord_x - radius, 0), min(coord_x + radius, width - 1)
+			y_min, y_max = max(coord_y - radius, 0), min(coord_y + radius, height - 1)
+			n = 0
+			for y in range(y_min, y_max + 1):
+				for x in range(x_min, x_max + 1):
+					if (x - coord_x)**2 + (y - coord_y)**2 > radius**2:
+						continue
+					buf[n] = img[y, x]
+					n += 1
+			k = int(n*threshold_pct)
+			if k > 0:
+				for point in np.partition(buf[:n], n - k)[n - k:]:
+					totals[i] += np.int64(point)
+		return totals.sum()
+
+	@njit(cache=True) # serial for the same reason as _score_numba
+	def _subtract_numba(minuend_image, subtrahend_image, ratio, out):
+		height, width = minuend_image.shape
+		for y in range(height):
+			for x in range(width):
+				# scale and subtract without underflow
+				value = np.int64(minuend_image[y, x]) - np.int64(subtrahend_image[y, x] * ratio)
+				out[y, x] = 0 if value < 0 else value
+		return out
+
 def _test():
+	global _NUMBA_AVAILABLE
+	numba_available = _NUMBA_AVAILABLE
+	minuend_image = np.array([[31_010, 60_000, 50_000]], dtype=np.uint16)
+	subtrahend_image = np.array([[34_289, 20_000, 25_000]], dtype=np.uint16) # scaled 2x
+	try:
+		for _NUMBA_AVAILABLE in {False, numba_available}: # saturating scaled subtrahend on both paths
+			assert subtract(minuend_image, subtrahend_image).tolist() == [[0, 20_000, 0]]
+	finally:
+		_NUMBA_AVAILABLE = numba_available
+
+	fork_img = np.random.default_rng(1).integers(0, 2**16, (120, 160)).astype(np.uint16)
+	expected = (score(fork_img), subtract(fork_img, fork_img[::-1]))
+	with multiprocessing.Pool(2) as pool: # forking after the kernels have run must not hang or abort
+		assert pool.apply_async(score, (fork_img,)).get(timeout=60) == expected[0]
+		assert np.array_equal(
+			pool.apply_async(subtract, (fork_img, fork_img[::-1])).get(timeout=60), expected[1])
+
+	rng = np.random.default_rng(0)
+	noise_img = rng.integers(0, 2**16, (120, 160)).astype(np.uint16)
+	plateau_img = np.kron(rng.integers(0, 8, (12, 16)), np.ones((10, 10))).astype(np.uint8)
+	flat_img = np.full((40, 40), 7, dtype=np.uint16)
+	for img in (noise_img, plateau_img, flat_img, noise_img[:10, :10]):
+		for count, spacing in ((10, 8), (50, 3)):
+			assert np.array_equal(_get_local_maxima(img, count=count, spacing=spacing),
+				feature.peak_local_max(img, min_distance=spacing, num_peaks=count, threshold_rel=0.1))
+
+	assert binarize(np.array([[1, 5]], dtype=np.uint16), np.uint16(3)).tolist() == [[255, 0]]
+	assert rescale_brightness(np.array([[1.5, 2.0, 2.5]])).tolist() == [[0, 51, 102]] # no early truncation
+
 	assert _get_bit_depth(np.array([1, 2, 3, 4, 5])) == (np.uint8, 255)
 	assert _get_bit_depth(np.array([1, 2, 3, 4, 255])) == (np.uint8, 255)
 	assert _get_bit_depth(np.array([1, 2, 3, 4, 256])) == (np.uint16, 65_535)
 	assert _get_bit_depth(np.array([1, 2, 3, 4, 65_536])) == (np.int32, 2_147_483_647)
+	assert _get_bit_depth(np.array([1, 2, 3, 4, 5], dtype=np.uint16)) == (np.uint16, 65_535)
+	assert _get_bit_depth(np.array([1, 2, 3, 4, 5], dtype=np.int32)) == (np.int32, 2_147_483_647)
+	assert _get_bit_depth(np.array([1, 2, 3, 4, 5], dtype=np.uint16), from_data=True) == \
+		(np.uint8, 255)
 
 #
 # main
@@ -34,7 +34,7 @@ class InfectionImage(analyze.Image):
 	def get_raw_value(self, threshold=0.02):
 		if self.value is None:
 			fl_img_masked = imageops.apply_mask(self.get_fl_img(), self.get_mask())
-			max_value = imageops._get_bit_depth(fl_img_masked)[1]
+			max_value = imageops._get_bit_depth(fl_img_masked, from_data=True)[1] # cutoff follows the data
 			total = fl_img_masked.sum(
 				dtype=np.uint64, where=(fl_img_masked > max_value*threshold))
 			self.value = total if total > 0 else np.nan
@@ -171,7 +171,7 @@ if __name__ == '__main__':
 
 	analyze.set_arguments(parser)
 
-	util.remove_arguments(parser, 'plate_ignore', 'group_regex')
+	util.remove_arguments(parser, 'plate_ignore', 'group_regex', 'processes')
 
 	args = parser.parse_args(sys.argv[1:])
 	args_dict = vars(args)
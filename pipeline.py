@@ -117,8 +117,8 @@ def generate_plate_schematic(schematic, results, conversions=None, plate_info='[
 
 def main(imagefiles, cap=-1, chartfile=None, checkerboard=False, conversions=[], debug=0,
 		group_regex='.*', platefile=None, plate_control=['B'], plate_ignore=[], plate_info=None,
-		plate_positive_control=[], treatment_platefile=None, absolute_chart=False, silent=False,
-		talk=False):
+		plate_positive_control=[], treatment_platefile=None, absolute_chart=False, processes=None,
+		silent=False, talk=False):
 	hashfile = util.get_inputs_hashfile(imagefiles=imagefiles, cap=cap, group_regex=group_regex,
 		platefile=platefile, plate_control=plate_control, plate_ignore=plate_ignore)
 
@@ -142,7 +142,7 @@ def main(imagefiles, cap=-1, chartfile=None, checkerboard=False, conversions=[],
 			results = json.load(f)
 	else:
 		results = analyze.main(imagefiles, cap, chartfile, debug, group_regex, platefile,
-			plate_control, plate_ignore, silent=False)
+			plate_control, plate_ignore, processes=processes, silent=False)
 		with open(hashfile, 'w') as f: # cache results for reuse
 			json.dump(results, f)
 
@@ -1,12 +1,14 @@
 import base64
 import configparser
 import csv
+import functools
 import hashlib
 import math
 import numpy as np
 import os
 import pickle
 import re
+import sys
 
 _config = None
 _section = 'Main'
@@ -209,6 +211,7 @@ def extract_number(string):
 def geometric_mean(array):
 	return np.exp(np.mean(np.log(array)))
 
+@functools.lru_cache(maxsize=None)
 def get_config(setting, fallback=None):
 	global _config
 	if _config == None: